@@ -1,71 +1,45 @@
 #!/usr/bin/env python3
-import csv
-import json
+import asyncio
+import gzip
 import os
 import sys
-import time
-from typing import Dict, Any
-from urllib.parse import quote, urlencode
-from urllib.request import Request, urlopen
-
-
-UTRECHT_CENTER = (5.1214201, 52.0907374)  # lon, lat
-RATE_LIMIT_DELAY = 0.15
-
-
-def read_rows(csv_path: str):
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            row["__row"] = i
-            yield row
-
-
-def build_full_address(row: Dict[str, Any]) -> str:
-    adres = (row.get("Adres") or "").strip()
-    postcode = (row.get("Postcode") or "").strip()
-    return ", ".join([p for p in [adres, postcode, "Utrecht, Nederland"] if p])
-
-
-def geocode(address: str, token: str):
-    base = "https://api.mapbox.com/geocoding/v5/mapbox.places/" + quote(address) + ".json"
-    qs = {
-        "access_token": token,
-        "limit": 1,
-        "proximity": f"{UTRECHT_CENTER[0]},{UTRECHT_CENTER[1]}",
-        "language": "nl",
-        "country": "nl",
-    }
-    url = base + "?" + urlencode(qs)
-    req = Request(url, headers={"User-Agent": "cycling-diner/1.0"})
-    with urlopen(req) as resp:
-        data = json.load(resp)
-    feats = data.get("features") or []
-    if not feats:
-        return None
-    c = feats[0].get("center")
-    return (float(c[0]), float(c[1])) if c else None
-
-
-def sanitize_props(row: Dict[str, Any]) -> Dict[str, Any]:
-    # Keep only non-sensitive fields for Studio
-    keep = {
-        "Naam persoon A": "naamA",
-        "Naam persoon B": "naamB",
-        "Adres": "adres",
-        "Postcode": "postcode",
-        "Stad": "stad",
-        "Team persoon A": "teamA",
-        "Team persoon B": "teamB",
-        "Dieetwensen": "dieet",
-        "Allergieën": "allergie",
-        "Overige opmerkingen": "opmerking",
-    }
-    out = {v: (row.get(k) or "").strip() for k, v in keep.items()}
-    out["row"] = row.get("__row")
+from collections import defaultdict
+from typing import Dict, Any, List, Tuple
+
+from geocode_utils import geocode_many, iter_utrecht_rows, json_dumps, normalize_address, open_session
+
+
+# Keep only non-sensitive fields for Studio (CSV column, property)
+_KEEP = (
+    ("Naam persoon A", "naamA"),
+    ("Naam persoon B", "naamB"),
+    ("Adres", "adres"),
+    ("Postcode", "postcode"),
+    ("Stad", "stad"),
+    ("Team persoon A", "teamA"),
+    ("Team persoon B", "teamB"),
+    ("Dieetwensen", "dieet"),
+    ("Allergieën", "allergie"),
+    ("Overige opmerkingen", "opmerking"),
+)
+_KEEP_COLUMNS = tuple(k for k, _ in _KEEP)
+_KEEP_PROPS = tuple(v for _, v in _KEEP)
+
+# A Feature up to its properties object; filled in with (lon, lat)
+FEATURE_HEAD = b'{"type":"Feature","geometry":{"type":"Point","coordinates":[%.6f,%.6f]},"properties":'
+
+
+def sanitize_props(values: List[str], index: int) -> Dict[str, Any]:
+    out = dict(zip(_KEEP_PROPS, map(str.strip, values)))
+    out["row"] = index
     return out
 
 
+async def geocode_rows(addresses, token):
+    async with open_session() as session:
+        return await geocode_many(session, addresses, token)
+
+
 def main():
     token = os.getenv("MAPBOX_TOKEN")
     if not token:
@@ -79,38 +53,46 @@ def main():
         print(f"CSV not found: {csv_path}", file=sys.stderr)
         sys.exit(1)
 
-    features = []
-    for row in read_rows(csv_path):
-        stad = (row.get("Stad") or "").strip().lower()
-        if stad and stad != "utrecht":
-            continue
-        address = build_full_address(row)
-        if not address:
-            continue
-        try:
-            coord = geocode(address, token)
-        except Exception as e:
-            print(f"Geocoding failed for '{address}': {e}", file=sys.stderr)
-            coord = None
-        if not coord:
-            print(f"No result for '{address}'", file=sys.stderr)
-            continue
-        lon, lat = coord
-        props = sanitize_props(row)
-        features.append(
-            {
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": [lon, lat]},
-                "properties": props,
-            }
-        )
-        time.sleep(RATE_LIMIT_DELAY)
-
-    fc = {"type": "FeatureCollection", "features": features}
+    # Rows sharing an address (e.g. a duo living together) are geocoded once
+    addr_to_rows: Dict[str, List[Tuple[int, str, List[str]]]] = defaultdict(list)
+    for index, address, values in iter_utrecht_rows(csv_path, _KEEP_COLUMNS):
+        addr_to_rows[normalize_address(address)].append((index, address, values))
+    groups = list(addr_to_rows.values())
+    results = asyncio.run(geocode_rows([rows[0][1] for rows in groups], token))
+
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(fc, f, ensure_ascii=False)
-    print(f"Wrote {len(features)} features to {out_path}")
+    written = 0
+    # Write next to the target and move it into place only once complete,
+    # so an aborted run never leaves a truncated file that looks finished
+    tmp_path = out_path + ".tmp"
+    if out_path.endswith(".gz"):
+        # Level 3: most of the ratio on repetitive JSON at a fraction of level 9's CPU
+        out = gzip.open(tmp_path, "wb", compresslevel=3)
+    else:
+        out = open(tmp_path, "wb")
+    try:
+        with out as f:
+            f.write(b'{"type":"FeatureCollection","features":[')
+            for rows, coord in zip(groups, results):
+                address = rows[0][1]
+                if isinstance(coord, Exception):
+                    print(f"Geocoding failed for '{address}': {coord}", file=sys.stderr)
+                    coord = None
+                if not coord:
+                    print(f"No result for '{address}'", file=sys.stderr)
+                    continue
+                # Only the properties differ between rows sharing a coordinate
+                head = FEATURE_HEAD % coord
+                for index, _, values in rows:
+                    feat = head + json_dumps(sanitize_props(values, index)) + b"}"
+                    f.write(b"," + feat if written else feat)
+                    written += 1
+            f.write(b"]}")
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    print(f"Wrote {written} features to {out_path}")
 
 
 if __name__ == "__main__":
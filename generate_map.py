@@ -1,79 +1,45 @@
 #!/usr/bin/env python3
-import csv
-import json
+import asyncio
 import os
 import sys
-import time
-from urllib.parse import quote, urlencode
-from urllib.request import urlopen, Request
+from urllib.parse import urlencode
+
+import aiohttp
+
+from geocode_utils import UTRECHT_CENTER, geocode_many, iter_utrecht_rows, open_session
 
 
-UTRECHT_CENTER = (5.1214201, 52.0907374)  # lon, lat
 DEFAULT_ZOOM = 12
 DEFAULT_SIZE = (1280, 1280)
 MARKER_COLOR = "ff2d20"  # red-ish
-RATE_LIMIT_DELAY = 0.15  # seconds between geocoding requests
+MAX_URL_LENGTH = 8192  # Mapbox Static Images API request limit
+DOWNLOAD_CONCURRENCY = 4  # static image downloads in flight
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 def read_addresses(csv_path: str):
-    addresses = []
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            stad = (row.get("Stad") or "").strip()
-            adres = (row.get("Adres") or "").strip()
-            postcode = (row.get("Postcode") or "").strip()
-            if not adres:
-                continue
-            # Prefer Utrecht, but include all if no Stad column match
-            if stad and stad.lower() != "utrecht":
-                continue
-            full = ", ".join([p for p in [adres, postcode, "Utrecht, Nederland"] if p])
-            addresses.append(full)
     # Deduplicate while preserving order
     seen = set()
     unique = []
-    for a in addresses:
-        if a not in seen:
-            seen.add(a)
-            unique.append(a)
+    for _, full, _ in iter_utrecht_rows(csv_path):
+        if full not in seen:
+            seen.add(full)
+            unique.append(full)
     return unique
 
 
-def geocode_address(address: str, token: str):
-    base = "https://api.mapbox.com/geocoding/v5/mapbox.places/" + quote(address) + ".json"
-    qs = {
-        "access_token": token,
-        "limit": 1,
-        "proximity": f"{UTRECHT_CENTER[0]},{UTRECHT_CENTER[1]}",
-        "language": "nl",
-        "country": "nl",
-    }
-    url = base + "?" + urlencode(qs)
-    req = Request(url, headers={"User-Agent": "cycling-diner/1.0"})
-    with urlopen(req) as resp:
-        data = json.load(resp)
-    feats = data.get("features") or []
-    if not feats:
-        return None
-    # center: [lon, lat]
-    return feats[0].get("center")
-
-
-def geocode_all(addresses, token):
+async def geocode_all(session: aiohttp.ClientSession, addresses, token):
+    results = await geocode_many(session, addresses, token)
     coords = []  # list of (lon, lat)
-    for idx, addr in enumerate(addresses, start=1):
-        try:
-            c = geocode_address(addr, token)
-        except Exception as e:
-            print(f"Geocoding error for '{addr}': {e}", file=sys.stderr)
+    for addr, c in zip(addresses, results):
+        if isinstance(c, Exception):
+            print(f"Geocoding error for '{addr}': {c}", file=sys.stderr)
             c = None
         if c:
             lon, lat = float(c[0]), float(c[1])
             coords.append((lon, lat))
         else:
             print(f"Warning: no result for '{addr}'", file=sys.stderr)
-        time.sleep(RATE_LIMIT_DELAY)
     # Deduplicate coordinates
     seen = set()
     unique_coords = []
@@ -84,12 +50,21 @@ def geocode_all(addresses, token):
     return unique_coords
 
 
-def build_marker_overlays(coords):
+def build_marker_overlays(coords, max_len: int):
     # Mapbox static marker overlay: pin-s+COLOR(lon,lat)
+    # Yields (overlays, marker count), each overlay string at most max_len long
+    markers = (f"pin-s+{MARKER_COLOR}({lon:.6f},{lat:.6f})" for lon, lat in coords)
     parts = []
-    for lon, lat in coords:
-        parts.append(f"pin-s+{MARKER_COLOR}({lon:.6f},{lat:.6f})")
-    return ",".join(parts)
+    used = -1  # no leading comma
+    for marker in markers:
+        if parts and used + 1 + len(marker) > max_len:
+            yield ",".join(parts), len(parts)
+            parts = []
+            used = -1
+        used += 1 + len(marker)
+        parts.append(marker)
+    if parts:
+        yield ",".join(parts), len(parts)
 
 
 def build_static_url(overlays: str, token: str, center=UTRECHT_CENTER, zoom=DEFAULT_ZOOM, size=DEFAULT_SIZE):
@@ -101,15 +76,46 @@ def build_static_url(overlays: str, token: str, center=UTRECHT_CENTER, zoom=DEFA
     return f"{base}{path}?{urlencode({'access_token': token})}"
 
 
-def download(url: str, out_path: str):
-    req = Request(url, headers={"User-Agent": "cycling-diner/1.0"})
-    with urlopen(req) as resp, open(out_path, "wb") as f:
-        f.write(resp.read())
+async def download(session: aiohttp.ClientSession, url: str, out_path: str):
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        with open(out_path, "wb") as f:
+            async for block in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                f.write(block)
+
+
+async def run(addresses, token):
+    async with open_session() as session:
+        coords = await geocode_all(session, addresses, token)
+        print(f"Resolved {len(coords)} coordinate pairs.")
+
+        if not coords:
+            print("No coordinates resolved; nothing to map.")
+            return
 
+        # Fill each image with as many markers as fit under MAX_URL_LENGTH
+        budget = MAX_URL_LENGTH - len(build_static_url("", token))
+        chunks = list(build_marker_overlays(coords, budget))
+        if len(chunks) == 1:
+            out = "utrecht_markers.png"
+            print(f"Downloading static map to {out}…")
+            await download(session, build_static_url(chunks[0][0], token), out)
+            print(f"Saved {out}")
+            return
 
-def chunk(iterable, n):
-    for i in range(0, len(iterable), n):
-        yield iterable[i:i+n]
+        # URL too long; split into multiple images
+        print(f"URL too long for a single image; splitting markers over {len(chunks)} images…")
+        sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+        async def fetch(i, overlays, count):
+            url = build_static_url(overlays, token)
+            out = f"utrecht_markers_{i}.png"
+            async with sem:
+                print(f"Downloading {out} ({count} markers)…")
+                await download(session, url, out)
+
+        await asyncio.gather(*[fetch(i, *chunk) for i, chunk in enumerate(chunks, start=1)])
+        print("Done.")
 
 
 def main():
@@ -129,35 +135,7 @@ def main():
         sys.exit(0)
 
     print(f"Found {len(addresses)} Utrecht addresses. Geocoding…")
-    coords = geocode_all(addresses, token)
-    print(f"Resolved {len(coords)} coordinate pairs.")
-
-    if not coords:
-        print("No coordinates resolved; nothing to map.")
-        sys.exit(0)
-
-    # Build overlays, respecting URL length. Aim for conservative chunk sizes.
-    # Each marker ~ 30–40 chars; 150 markers ~ ~6k chars. Keep chunks to 120 markers.
-    overlays_all = build_marker_overlays(coords)
-    test_url = build_static_url(overlays_all, token)
-    if len(test_url) < 7800:
-        out = "utrecht_markers.png"
-        print(f"Downloading static map to {out}…")
-        download(test_url, out)
-        print(f"Saved {out}")
-        return
-
-    # URL too long; split into multiple images
-    print("URL too long for a single image; chunking markers…")
-    # Roughly 100 markers per chunk; adjust as needed
-    per = 100
-    for i, sub in enumerate(chunk(coords, per), start=1):
-        overlays = build_marker_overlays(sub)
-        url = build_static_url(overlays, token)
-        out = f"utrecht_markers_{i}.png"
-        print(f"Downloading {out}…")
-        download(url, out)
-    print("Done.")
+    asyncio.run(run(addresses, token))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+import asyncio
+import csv
+import json
+import os
+import random
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import quote, urlencode
+
+import aiohttp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+UTRECHT_CENTER = (5.1214201, 52.0907374)  # lon, lat
+RATE_LIMIT_DELAY = 0.25  # base back-off (seconds), doubled on every retry
+MAX_BACKOFF = 60  # never wait longer than this, whatever the server suggests
+MAX_ATTEMPTS = 5  # tries per request on 429, 5xx, connection errors and timeouts
+CONCURRENCY = 10  # geocoding requests in flight
+BATCH_SIZE = int(os.getenv("GEOCODE_BATCH_SIZE", "50"))  # 1 = one request per address
+BATCH_URL = "https://api.mapbox.com/search/geocode/v6/batch"
+CACHE_PATH = os.getenv("GEOCODE_CACHE", "data/.geocache.sqlite")
+USER_AGENT = "cycling-diner/1.0"
+# Worker processes for uncached lookups; only worth it for thousands of addresses.
+# They split CONCURRENCY between them (at least one request each), but back off
+# independently after a 429.
+WORKERS = int(os.getenv("GEOCODE_WORKERS", "1"))
+
+
+def json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    # UTF-8 encoded JSON, non-ASCII kept as-is
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+_UTRECHT_SPELLINGS = frozenset(("Utrecht", "utrecht", "UTRECHT"))
+
+
+def _cell(row, i: int) -> str:
+    # Missing columns map to -1; short rows simply lack trailing cells
+    return row[i] if 0 <= i < len(row) else ""
+
+
+def iter_utrecht_rows(csv_path: str, columns: Sequence[str] = ()) -> Iterator[Tuple[int, str, List[str]]]:
+    # Yields (row index, full address, values of `columns`) for every geocodable Utrecht row
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        col = {name: i for i, name in enumerate(header)}
+        stad_i = col.get("Stad", -1)
+        adres_i = col.get("Adres", -1)
+        postcode_i = col.get("Postcode", -1)
+        wanted = [col.get(name, -1) for name in columns]
+        for i, row in enumerate(r for r in reader if r):
+            # Prefer Utrecht, but include all if no Stad column match;
+            # only casefold spellings other than the usual ones
+            stad = _cell(row, stad_i).strip()
+            if stad and stad not in _UTRECHT_SPELLINGS and stad.casefold() != "utrecht":
+                continue
+            adres = _cell(row, adres_i).strip()
+            if not adres:
+                continue
+            postcode = _cell(row, postcode_i).strip()
+            if postcode:
+                full = f"{adres}, {postcode}, Utrecht, Nederland"
+            else:
+                full = f"{adres}, Utrecht, Nederland"
+            yield i, full, [_cell(row, j) for j in wanted]
+
+
+def normalize_address(address: str) -> str:
+    return re.sub(r"\s+", " ", address.strip().lower())
+
+
+def open_cache(path: str = CACHE_PATH) -> sqlite3.Connection:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocache "
+        "(key TEXT PRIMARY KEY, lon REAL, lat REAL, ts INTEGER)"
+    )
+    return conn
+
+
+def open_session() -> aiohttp.ClientSession:
+    # One keep-alive pool for every Mapbox call in a run
+    connector = aiohttp.TCPConnector(limit=16, limit_per_host=8)
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers={"User-Agent": USER_AGENT})
+
+
+def _retry_after(headers) -> Optional[float]:
+    # Seconds the server asks us to wait, if it says so
+    try:
+        if "Retry-After" in headers:
+            return float(headers["Retry-After"])
+        if "X-Rate-Limit-Reset" in headers:
+            # Unix timestamp at which the rate limit window resets
+            return max(0.0, float(headers["X-Rate-Limit-Reset"]) - time.time())
+    except ValueError:
+        pass
+    return None
+
+
+async def fetch_json(session: aiohttp.ClientSession, method: str, url: str, **kwargs):
+    for attempt in range(MAX_ATTEMPTS):
+        last = attempt == MAX_ATTEMPTS - 1
+        wait = None
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                if last or (resp.status != 429 and resp.status < 500):
+                    resp.raise_for_status()
+                    return json_loads(await resp.read())
+                wait = _retry_after(resp.headers)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last:
+                raise
+        if wait is None:
+            wait = RATE_LIMIT_DELAY * 2 ** attempt + random.random() * 0.1
+        await asyncio.sleep(min(wait, MAX_BACKOFF))
+
+
+@lru_cache(maxsize=None)
+def _query_suffix(token: str) -> str:
+    return "?" + urlencode(
+        {
+            "access_token": token,
+            "limit": 1,
+            "proximity": f"{UTRECHT_CENTER[0]},{UTRECHT_CENTER[1]}",
+            "language": "nl",
+            "country": "nl",
+        }
+    )
+
+
+@lru_cache(maxsize=4096)
+def _quote(address: str) -> str:
+    return quote(address, safe="")
+
+
+async def geocode(session: aiohttp.ClientSession, address: str, token: str, sem: asyncio.Semaphore):
+    url = f"https://api.mapbox.com/geocoding/v5/mapbox.places/{_quote(address)}.json{_query_suffix(token)}"
+    async with sem:
+        data = await fetch_json(session, "GET", url)
+    feats = data.get("features") or []
+    if not feats:
+        return None
+    # center: [lon, lat]
+    c = feats[0].get("center")
+    return (float(c[0]), float(c[1])) if c else None
+
+
+async def geocode_batch(session: aiohttp.ClientSession, addresses, token: str, sem: asyncio.Semaphore):
+    body = [
+        {
+            "types": ["address"],
+            "q": address,
+            "proximity": list(UTRECHT_CENTER),
+            "language": "nl",
+            "country": "nl",
+            "limit": 1,
+        }
+        for address in addresses
+    ]
+    async with sem:
+        data = await fetch_json(
+            session,
+            "POST",
+            BATCH_URL,
+            params={"access_token": token},
+            data=json_dumps(body),
+            headers={"Content-Type": "application/json"},
+        )
+    coords = []
+    # Answers come back in the same order as the queries
+    for result in data.get("batch") or []:
+        feats = result.get("features") or []
+        c = feats[0].get("geometry", {}).get("coordinates") if feats else None
+        coords.append((float(c[0]), float(c[1])) if c else None)
+    if len(coords) != len(addresses):
+        raise RuntimeError(f"batch returned {len(coords)} results for {len(addresses)} queries")
+    return coords
+
+
+async def geocode_uncached(session: aiohttp.ClientSession, addresses, token, concurrency: int = CONCURRENCY):
+    # Results line up with `addresses`: a (lon, lat) tuple, None, or the exception raised
+    sem = asyncio.Semaphore(concurrency)
+    if BATCH_SIZE <= 1:
+        return await asyncio.gather(
+            *[geocode(session, address, token, sem) for address in addresses],
+            return_exceptions=True,
+        )
+    groups = [addresses[i:i + BATCH_SIZE] for i in range(0, len(addresses), BATCH_SIZE)]
+    answers = await asyncio.gather(
+        *[geocode_batch(session, group, token, sem) for group in groups],
+        return_exceptions=True,
+    )
+    results = []
+    for group, answer in zip(groups, answers):
+        # A failed batch fails every address in it
+        results.extend([answer] * len(group) if isinstance(answer, Exception) else answer)
+    return results
+
+
+async def _geocode_shard_async(addresses, token, concurrency: int):
+    async with open_session() as session:
+        return await geocode_uncached(session, addresses, token, concurrency)
+
+
+def _geocode_shard(addresses, token, concurrency: int):
+    # Runs in a worker process with its own event loop and keep-alive pool
+    results = asyncio.run(_geocode_shard_async(addresses, token, concurrency))
+    # aiohttp exceptions do not always survive pickling back to the parent
+    return [RuntimeError(str(r)) if isinstance(r, Exception) else r for r in results]
+
+
+async def geocode_many(session: aiohttp.ClientSession, addresses, token):
+    # Results line up with `addresses`: a (lon, lat) tuple, None, or the exception raised
+    conn = open_cache()
+    try:
+        keys = [normalize_address(address) for address in addresses]
+        results = [
+            conn.execute("SELECT lon, lat FROM geocache WHERE key=?", (key,)).fetchone()
+            for key in keys
+        ]
+        misses = [i for i, hit in enumerate(results) if hit is None]
+        pending = [addresses[i] for i in misses]
+
+        if WORKERS > 1 and len(pending) > 1:
+            size = -(-len(pending) // WORKERS)
+            shards = [pending[i:i + size] for i in range(0, len(pending), size)]
+            # Workers share the CONCURRENCY budget rather than each getting their own
+            per_worker = max(1, CONCURRENCY // len(shards))
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+                answers = await asyncio.gather(
+                    *[loop.run_in_executor(pool, _geocode_shard, shard, token, per_worker) for shard in shards]
+                )
+            answers = [answer for shard in answers for answer in shard]
+        else:
+            answers = await geocode_uncached(session, pending, token)
+        for i, answer in zip(misses, answers):
+            results[i] = answer
+
+        now = int(time.time())
+        conn.executemany(
+            "INSERT OR REPLACE INTO geocache (key, lon, lat, ts) VALUES (?, ?, ?, ?)",
+            [
+                (keys[i], results[i][0], results[i][1], now)
+                for i in misses
+                if results[i] and not isinstance(results[i], Exception)
+            ],
+        )
+        conn.commit()
+        return results
+    finally:
+        conn.close()